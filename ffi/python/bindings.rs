@@ -47,6 +47,14 @@ impl Address {
         }
     }
 
+    #[staticmethod]
+    fn from_batch(addresses: Vec<Vec<u8>>, max_depth: u32) -> PyResult<Vec<Self>> {
+        addresses
+            .into_iter()
+            .map(|address| Self::new(address, max_depth))
+            .collect()
+    }
+
     fn get(&self) -> Vec<u8> {
         self.address.clone().into()
     }
@@ -1,7 +1,9 @@
 import math
 import typing as T
 
-from generate.common import random
+import numpy as np
+
+from generate.common import numpy_random
 from generate.data import MapConfig
 from generate.layer import Layer, Tile
 from generate.quadtree import Quadtree, ConvolveData
@@ -34,8 +36,13 @@ class Agents(Layer):
 
         # TODO: use LODES data to generate actual commutes
         # for now, we just assign commutes randomly
-        housing = []
-        workplaces = []
+
+        # addresses and densities of housing and workplace tiles. Each unit of density
+        # becomes a separate home or job, which is expanded below.
+        housing_addresses = []
+        housing_density = []
+        workplace_addresses = []
+        workplace_density = []
 
         def count_tiles(node, data):
             if (
@@ -44,38 +51,59 @@ class Agents(Layer):
                 and "type" in node.data["tile"]
             ):
                 t = node.data["tile"]["type"]
+                # NOTE: data.address is reused by the traversal, so it needs copying
                 if t == "HousingTile":
-                    for _ in range(node.data["tile"]["density"]):
-                        housing.append(engine.Address(data.address, qtree.max_depth))
+                    housing_addresses.append(list(data.address))
+                    housing_density.append(node.data["tile"]["density"])
                 elif t == "WorkplaceTile":
-                    for _ in range(node.data["tile"]["density"]):
-                        workplaces.append(engine.Address(data.address, qtree.max_depth))
+                    workplace_addresses.append(list(data.address))
+                    workplace_density.append(node.data["tile"]["density"])
 
         qtree.convolve(count_tiles)
 
+        # convert all of the addresses in one call each rather than one call per tile
+        housing_addresses = engine.Address.from_batch(
+            housing_addresses, qtree.max_depth
+        )
+        workplace_addresses = engine.Address.from_batch(
+            workplace_addresses, qtree.max_depth
+        )
+
+        # one entry per home/job, holding the index of its tile. add_agent copies the
+        # address, so all units of a tile can share the same instance.
+        housing = np.repeat(np.arange(len(housing_addresses)), housing_density)
+        workplaces = np.repeat(np.arange(len(workplace_addresses)), workplace_density)
+
         total_workers = min(len(housing), len(workplaces))
         print(f"housing: {len(housing)}, workplaces: {len(workplaces)}")
         print(f"adding {total_workers} working agents")
 
-        rand = random(self.map_config.name)
+        rng = numpy_random(self.map_config.name)
 
         def create_agent():
             # TODO: generate ages and education levels from some data source
             birthday = engine.Date.from_ymd(2000, 1, 1)
             return engine.AgentData(birthday, 16)
 
-        for _ in range(total_workers):
-            housing_id = housing.pop(rand.randrange(0, len(housing)))
-            workplace_id = workplaces.pop(rand.randrange(0, len(workplaces)))
+        # pair up housing and workplaces uniformly at random
+        rng.shuffle(housing)
+        rng.shuffle(workplaces)
 
-            state.add_agent(create_agent(), housing_id, workplace_id)
+        for housing_index, workplace_index in zip(
+            housing[:total_workers].tolist(), workplaces[:total_workers].tolist()
+        ):
+            state.add_agent(
+                create_agent(),
+                housing_addresses[housing_index],
+                workplace_addresses[workplace_index],
+            )
 
         # If we have more housing than workplaces (which should normally be true), then add agents
         # without jobs. This includes not just unemployed people, but also people not working for
         # various other reasons, e.g. because they are children, retired, or stay-at-home parents.
-        print(f"adding {len(housing)} non-working agents")
-        for housing_id in housing:
+        print(f"adding {len(housing) - total_workers} non-working agents")
+        for housing_index in housing[total_workers:].tolist():
 
-            state.add_agent(create_agent(), housing_id, None)
+            state.add_agent(create_agent(), housing_addresses[housing_index], None)
 
         # TODO: add additional empty housing
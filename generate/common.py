@@ -13,6 +13,19 @@ def random(seed):
     return random.Random(seed)
 
 
+@functools.lru_cache
+def numpy_random(seed: str):
+    # NOTE: same determinism caveats as random(). Unlike random.Random, NumPy only
+    # takes integer seeds, and hash() of a string changes between processes, so
+    # derive the seed with a stable hash instead.
+    import hashlib
+
+    import numpy as np
+
+    digest = hashlib.blake2b(seed.encode(), digest_size=8).digest()
+    return np.random.default_rng(int.from_bytes(digest, "little"))
+
+
 def parse_speed(speed: str) -> int:
     if speed.endswith(" mph"):
         kph = float(speed[:-4]) * 1.61
@@ -1,10 +1,9 @@
 import typing as T
 
-from collections import defaultdict
 from functools import cached_property
 from dataclasses import dataclass
 
-from shapely.geometry import Point
+import numpy as np
 
 from generate.common import parse_speed
 from generate.data import MapConfig
@@ -136,28 +135,38 @@ class Highways(Layer):
     def modify_state(self, state: T.Any, qtree: Quadtree) -> None:
         import engine
 
-        # each item is a (incoming, outgoing) tuple
-        coord_map: T.Dict[
-            T.Tuple[float, float], T.Tuple[T.List[osm.Way], T.List[osm.Way]]
-        ] = defaultdict(lambda: ([], []))
+        # Give each (rounded) endpoint of a motorway/trunk way an integer id, in the
+        # order that the endpoints are first encountered. Degrees and adjacency are then
+        # computed with array operations instead of building per-point lists of ways.
+        point_ids: T.Dict[T.Tuple[float, float], int] = {}
+        points_by_id: T.List[T.Tuple[float, float]] = []
+
+        def get_point_id(point: T.Tuple[float, float]) -> int:
+            point_id = point_ids.get(point)
+            if point_id is None:
+                point_id = point_ids[point] = len(points_by_id)
+                points_by_id.append(point)
+            return point_id
+
+        ways: T.List[osm.Way] = []
+        first_ids: T.List[int] = []
+        last_ids: T.List[int] = []
+        bidirectional: T.List[bool] = []
 
         on_ramps = set()
         off_ramps = set()
 
         for highway in self.osm.highways:
             # NOTE: saw one case of a self-loop, which has no boundary
-            if len(highway.shape.boundary.geoms) == 2:
-                first, last = (
-                    self.round_coords(c) for c in highway.shape.boundary.geoms
-                )
+            if highway.first != highway.last:
+                first = self.round_coords(highway.first)
+                last = self.round_coords(highway.last)
                 highway_tag = highway.tags.get("highway")
                 if highway_tag in ["motorway", "trunk"]:
-                    coord_map[first][1].append(highway)
-                    coord_map[last][0].append(highway)
-                    if not is_oneway(highway.tags):
-                        # also add a segment in the opposite direction
-                        coord_map[first][0].append(highway)
-                        coord_map[last][1].append(highway)
+                    ways.append(highway)
+                    first_ids.append(get_point_id(first))
+                    last_ids.append(get_point_id(last))
+                    bidirectional.append(not is_oneway(highway.tags))
                 elif highway_tag in ["motorway_link", "trunk_link"]:
                     # in general we might have an off-ramp at the start and an on-ramp at the end
                     off_ramps.add(first)
@@ -165,11 +174,29 @@ class Highways(Layer):
                 else:
                     raise Exception("Unrecognized highway tag: {}".format(highway_tag))
 
-        junctions = []
-        for (point, (in_ways, out_ways)) in coord_map.items():
-            if len(in_ways) + len(out_ways) != 2:
-                # 3+ is a junction, 1 is a dead-end
-                junctions.append((point, in_ways, out_ways))
+        first_arr = np.array(first_ids, dtype=np.int64)
+        last_arr = np.array(last_ids, dtype=np.int64)
+        bidir = np.array(bidirectional, dtype=bool)
+        way_indices = np.arange(len(ways))
+
+        # bidirectional ways also act as a way in the opposite direction
+        in_points = np.concatenate((last_arr, first_arr[bidir]))
+        out_points = np.concatenate((first_arr, last_arr[bidir]))
+        out_ways = np.concatenate((way_indices, way_indices[bidir]))
+
+        in_degree = np.bincount(in_points, minlength=len(points_by_id))
+        out_degree = np.bincount(out_points, minlength=len(points_by_id))
+
+        # outgoing ways of point p are out_order[out_offsets[p]:out_offsets[p + 1]],
+        # in the order that the ways were encountered
+        out_order = out_ways[np.lexsort((out_ways, out_points))].tolist()
+        out_offsets = np.concatenate(([0], np.cumsum(out_degree))).tolist()
+
+        # 3+ is a junction, 1 is a dead-end
+        junctions = np.flatnonzero(in_degree + out_degree != 2).tolist()
+
+        # only points with exactly one way in and one way out continue a line
+        pass_through = ((in_degree == 1) & (out_degree == 1)).tolist()
 
         # NOTE: This approach will fail to detect closed loops. For
         # now, we'll say that this is OK. To add support for closed
@@ -190,15 +217,16 @@ class Highways(Layer):
 
             segment_tuples.append((points, start, end, segment_data))
 
-        for (point, in_ways, out_ways) in junctions:
+        for point_id in junctions:
             # NOTE: only use diverging edges to avoid double-counting
-            for highway in out_ways:
+            out_start, out_end = out_offsets[point_id], out_offsets[point_id + 1]
+            for way_index in out_order[out_start:out_end]:
                 points: T.List[T.Tuple[float, float]] = []
-                way = highway
-                border_point = point
+                border_id = point_id
                 prev_segment_data = None
 
                 while True:
+                    way = ways[way_index]
                     cur_segment_data = SegmentData(
                         name=way.tags.get("name"),
                         ref=parse_ref(way.tags),
@@ -206,27 +234,28 @@ class Highways(Layer):
                         speed_limit=parse_speed_limit(way.tags),
                     )
 
-                    first, last = (
-                        self.round_coords(c) for c in way.shape.boundary.geoms
-                    )
-                    if first == border_point:
+                    first_id = first_ids[way_index]
+                    last_id = last_ids[way_index]
+                    if first_id == border_id:
                         # normal orientation
-                        border_point = last
-                        coords = way.shape.coords
-                    elif last == border_point:
+                        border_id = last_id
+                        coords = way.coords
+                    elif last_id == border_id:
                         # flipped
-                        border_point = first
-                        coords = list(reversed(way.shape.coords))
+                        border_id = first_id
+                        coords = way.coords[::-1]
                     else:
-                        assert False, (border_point, first, last)
+                        assert False, (
+                            points_by_id[border_id],
+                            points_by_id[first_id],
+                            points_by_id[last_id],
+                        )
 
                     # cut off segments that extend out of the region of interest
                     # TODO: split into two segments if this happens
-                    for (x, y) in coords:
-                        if not (0 <= x <= self.max_dim and 0 <= y <= self.max_dim):
-                            add_segment_tuple(points, prev_segment_data)
-                            points = []
-                            break
+                    if not np.all((coords >= 0) & (coords <= self.max_dim)):
+                        add_segment_tuple(points, prev_segment_data)
+                        points = []
                     else:
                         if (
                             prev_segment_data is not None
@@ -236,48 +265,50 @@ class Highways(Layer):
                             add_segment_tuple(points, prev_segment_data)
                             points = []
 
-                        points.extend(coords)
+                        points.extend(map(tuple, coords.tolist()))
                         prev_segment_data = cur_segment_data
 
-                    next_in_ways, next_out_ways = coord_map[border_point]
-
-                    if len(next_in_ways) != 1 or len(next_out_ways) != 1:
+                    if not pass_through[border_id]:
                         break
                     else:
                         # keep following the line
-                        way = next_out_ways[0]
+                        way_index = out_order[out_offsets[border_id]]
 
                 if prev_segment_data is not None:
                     add_segment_tuple(points, prev_segment_data)
 
-        # map from points to junction IDs
-        junction_map: T.Dict[T.Tuple[float, float], int] = {}
+        def bake_junction(point: T.Tuple[float, float]) -> int:
+            (x, y) = point
+            assert 0 <= x <= self.max_dim, (x, self.max_dim)
+            assert 0 <= y <= self.max_dim, (y, self.max_dim)
 
-        def get_junction_id(point: T.Tuple[float, float]) -> int:
-            if point in junction_map:
-                return junction_map[point]
+            if point in on_ramps:
+                ramp = engine.RampDirection.on_ramp()
+            elif point in off_ramps:
+                ramp = engine.RampDirection.off_ramp()
             else:
-                (x, y) = point
-                assert 0 <= x <= self.max_dim, (x, self.max_dim)
-                assert 0 <= y <= self.max_dim, (y, self.max_dim)
-
-                if point in on_ramps:
-                    ramp = engine.RampDirection.on_ramp()
-                elif point in off_ramps:
-                    ramp = engine.RampDirection.off_ramp()
-                else:
-                    ramp = None
-
-                junction_id = state.add_highway_junction(
-                    x, y, engine.HighwayJunctionData(ramp)
-                )
-                junction_map[point] = junction_id
-                return junction_id
-
-        for (points, start, end, segment_data) in segment_tuples:
-            # create junctions if needed
-            start_id = get_junction_id(start)
-            end_id = get_junction_id(end)
+                ramp = None
+
+            return state.add_highway_junction(x, y, engine.HighwayJunctionData(ramp))
+
+        # Resolve all segment endpoints to junctions at once. Each distinct endpoint
+        # gets one junction, created in the order that the endpoints first appear.
+        endpoints = np.array(
+            [(start, end) for (_, start, end, _) in segment_tuples]
+        ).reshape(-1, 2)
+        (unique_points, first_indices, inverse) = np.unique(
+            endpoints, axis=0, return_index=True, return_inverse=True
+        )
+        junction_ids = [0] * len(unique_points)
+        for point_index in np.argsort(first_indices).tolist():
+            junction_ids[point_index] = bake_junction(
+                tuple(unique_points[point_index].tolist())
+            )
+        endpoint_ids = [junction_ids[i] for i in inverse.reshape(-1).tolist()]
+
+        for (i, (points, _, _, segment_data)) in enumerate(segment_tuples):
+            start_id = endpoint_ids[2 * i]
+            end_id = endpoint_ids[2 * i + 1]
 
             data = engine.HighwaySegmentData(
                 segment_data.name,
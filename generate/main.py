@@ -25,7 +25,7 @@ from generate.layer import Layer, Tile
 from generate.data import Coords, MapConfig, round_to_pow2, centered_box
 from generate.gdal import read_gdal
 from generate.lodes import read_lodes
-from generate.osm import read_osm
+from generate.osm import read_osm, OsmData
 
 from generate import terrain, housing, workplaces, metros, highways, agents
 
@@ -190,6 +190,7 @@ def generate(
     plot_dir=None,
     profile_file=None,
     clean_script=None,
+    osm_cache_dir=None,
 ) -> None:
     if map_path.endswith(".toml"):
         map_config = MapConfig(**toml.load(map_path))
@@ -236,13 +237,16 @@ def generate(
             elif dataset_type == "lodes":
                 dataset = read_lodes(dataset_info, coords, max_dim)
             elif dataset_type == "open_street_map":
-                dataset = read_osm(dataset_info, coords, max_dim)
+                dataset = read_osm(dataset_info, coords, max_dim, osm_cache_dir)
             else:
                 raise Exception("Unrecognized dataset type: {}".format(dataset_type))
 
         if cleaner is not None and hasattr(cleaner, layer.get_name()):
             report_timestamp("cleaning - {}".format(layer.get_name()))
             getattr(cleaner, layer.get_name())(dataset)
+            if isinstance(dataset, OsmData):
+                # the cleaner may have modified the subways or stops
+                dataset.build_maps()
 
         report_timestamp("plot - {}".format(layer.get_name()))
         plotter.plot(layer.get_name(), dataset)
@@ -302,12 +306,15 @@ def generate(
         report_timestamp("bubble priority down")
         qtree.convolve(bubble_priority_down, post=False)
 
+        layer_names = [(layer, layer.get_name()) for layer in layers]
+
         def merge(node, convolve):
             if len(node.children) > 0:
-                for layer in layers:
-                    if all(
-                        layer.get_name() in child.data[0] for child in node.children
-                    ):
+                # NOTE: merging only modifies the contents of these dicts, so they can
+                # be shared by all layers
+                child_data = [child.data[0] for child in node.children]
+                for (layer, name) in layer_names:
+                    if all(name in data for data in child_data):
                         layer.merge(node, convolve)
 
             # mark nodes with minimum/maximum priorities of all entities that they contain
@@ -1,3 +1,4 @@
+import math
 import typing as T
 
 from abc import ABC, abstractmethod
@@ -5,7 +6,9 @@ from dataclasses import dataclass
 from functools import cached_property, lru_cache
 from enum import Enum
 
-from shapely.geometry import LineString, MultiPoint, Point
+import numpy as np
+import shapely
+from shapely.geometry import LineString, Point
 from shapely.ops import nearest_points
 from matplotlib.colors import to_rgba
 
@@ -175,6 +178,14 @@ class Metros(Layer):
                 stations.append(st)
                 stations_coord_map[(rx, ry)] = st
 
+        # spatial index of all stations, shared by all routes
+        stations_tree = shapely.STRtree(
+            shapely.points(np.array(stations_all_coords).reshape(-1, 2))
+        )
+
+        subway_map = self.osm.subway_map
+        stop_map = self.osm.stop_map
+
         for route in self.osm.subway_routes:
             # if we are crossing state boundaries, we have multiple copies of each route
             if route.id in seen_routes:
@@ -192,39 +203,40 @@ class Metros(Layer):
 
             # pull out ways
             for member in route.members:
-                if (
-                    member.type == "w"
-                    and member.ref in self.osm.subway_map
-                    and member.role == ""
-                ):
-                    subway = self.osm.subway_map[member.ref]
+                if member.type == "w" and member.role == "":
+                    subway = subway_map.get(member.ref)
+                    if subway is None:
+                        continue
 
                     if color is None:
                         color = subway.tags.get("colour")
 
-                    first, last = subway.shape.boundary.geoms
-                    if last_point is not None and last.distance(
-                        last_point
-                    ) < first.distance(last_point):
+                    if subway.first is None or subway.last is None:
+                        # way without any nodes
+                        continue
+
+                    first, last = subway.first, subway.last
+                    if last_point is not None and math.dist(
+                        last, last_point
+                    ) < math.dist(first, last_point):
                         # the way is flipped around for some reason. need to correct it
                         last_point = first
-                        coords = reversed(subway.shape.coords)
+                        coords = subway.coords[::-1]
                     else:
                         last_point = last
-                        coords = subway.shape.coords
+                        coords = subway.coords
 
-                    for (x, y) in coords:
+                    for (x, y) in coords.tolist():
                         # discard out-of-bounds data
                         if 0 <= x <= self.max_dim and 0 <= y <= self.max_dim:
                             if (x, y) not in spline_coord_map:
                                 spline_coord_map[(x, y)] = len(spline_all_coords)
                                 spline_all_coords.append((x, y))
-                elif (
-                    member.type == "n"
-                    and member.ref in self.osm.stop_map
-                    and member.role == "stop"
-                ):
-                    stop = self.osm.stop_map[member.ref]
+                elif member.type == "n" and member.role == "stop":
+                    stop = stop_map.get(member.ref)
+                    if stop is None:
+                        continue
+
                     x, y = stop.location
                     if 0 <= x <= self.max_dim and 0 <= y <= self.max_dim:
                         stops.append(stop)
@@ -238,27 +250,28 @@ class Metros(Layer):
             for x, y in spline_all_coords:
                 keys.append(MetroKey(x, y))
 
-            stations_multipoint = MultiPoint(stations_all_coords)
             spline_linestring = LineString(spline_all_coords)
-            spline_multipoint = MultiPoint(spline_all_coords)
+            spline_tree = shapely.STRtree(shapely.points(spline_all_coords))
 
             to_insert = {}
             line_stations = []
 
             for stop in stops:
                 # find the nearest point on the spline so that we can insert the stop
-                loc = Point(stop.location)
-                pt, _ = nearest_points(spline_multipoint, loc)
-                index = spline_coord_map[pt.coords[0]]
+                location = stop.location
+                loc = Point(location)
+                index = int(spline_tree.nearest(loc))
+                pt = spline_all_coords[index]
 
                 # Sometimes stops aren't actually on the line due to data errors. It's unclear which
                 # is correct (the line or the stop), but we don't have a good way of recovering, so
                 # we just ignore this stop.
                 max_stop_offset = 500 / self.map_config.engine_config["min_tile_size"]
-                if loc.distance(pt) > max_stop_offset:
+                stop_offset = math.dist(location, pt)
+                if stop_offset > max_stop_offset:
                     print(
                         "Warning: stop is too far from line, stop: {}, distance: {}".format(
-                            stop, loc.distance(pt)
+                            stop, stop_offset
                         )
                     )
                     continue
@@ -267,15 +280,15 @@ class Metros(Layer):
                 # TODO: This is only relevant if the stop location isn't one of the key points.
                 # For everything I've tested so far, the stop is also a key point, so this
                 # is basically untested (and it's unclear if it is ever necessary with OSM data).
-                prev = Point(spline_all_coords[index - 1])
+                prev = spline_all_coords[index - 1]
                 spline_pt, _ = nearest_points(spline_linestring, loc)
-                if prev.distance(spline_pt) < prev.distance(pt):
+                if math.dist(prev, spline_pt.coords[0]) < math.dist(prev, pt):
                     index -= 1
 
                 # find the nearest station so that we can associate this stop with the station
-                station_pt, _ = nearest_points(stations_multipoint, loc)
+                station_index = int(stations_tree.nearest(loc))
                 station_x, station_y = round_station_location(
-                    (station_pt.x, station_pt.y)
+                    stations_all_coords[station_index]
                 )
                 station_address = address_from_coords(
                     station_x,
@@ -285,7 +298,7 @@ class Metros(Layer):
                 station_data = stations_coord_map[(station_x, station_y)]
                 line_stations.append(station_data)
 
-                x, y = stop.location
+                x, y = location
                 to_insert[index] = MetroStop(
                     x, y, station_data.name, station_address, self.max_depth
                 )
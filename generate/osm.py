@@ -1,23 +1,85 @@
 from __future__ import annotations
 
+import os
 import typing as T
-import json
+import hashlib
+import pickle
 from dataclasses import dataclass
-import functools
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import operator
 
-import shapely.geometry
-from shapely.affinity import affine_transform
+import ijson
+import numpy as np
+import orjson
+import shapely
 
 from generate.data import Coords, round_to_pow2, centered_box, EQ_KM_PER_DEG
 
 
+@T.overload
 def undecimicro(val: int) -> float:
+    ...
+
+
+@T.overload
+def undecimicro(val: np.ndarray) -> np.ndarray:
+    ...
+
+
+def undecimicro(val):
     return val / 10**7
 
 
+def affine_coords(coords: np.ndarray, matrix: T.List[float]) -> np.ndarray:
+    """
+    Apply a shapely-style affine transformation matrix [a, b, d, e, xoff, yoff]
+    to an (N, 2) array of coordinates.
+    """
+    (a, b, d, e, xoff, yoff) = matrix
+    return coords @ np.array([[a, d], [b, e]]) + np.array([xoff, yoff])
+
+
+def compose_affine(outer: T.List[float], inner: T.List[float]) -> T.List[float]:
+    """
+    Compose two shapely-style affine transformation matrices into a single matrix
+    that applies inner and then outer.
+    """
+    (a2, b2, d2, e2, xoff2, yoff2) = outer
+    (a1, b1, d1, e1, xoff1, yoff1) = inner
+    return [
+        a2 * a1 + b2 * d1,
+        a2 * b1 + b2 * e1,
+        d2 * a1 + e2 * d1,
+        d2 * b1 + e2 * e1,
+        a2 * xoff1 + b2 * yoff1 + xoff2,
+        d2 * xoff1 + e2 * yoff1 + yoff2,
+    ]
+
+
+def build_linestrings(
+    coords: np.ndarray, lengths: T.List[int]
+) -> T.Tuple[np.ndarray, T.List[np.ndarray]]:
+    """
+    Build one linestring per consecutive run of the given lengths in an (N, 2) array
+    of coordinates, all in a single shapely call. Runs of length zero become empty
+    linestrings. Also returns the coordinates of each linestring as views into coords.
+    """
+    # NOTE: shapely rejects indices with gaps unless they are written into an existing
+    # array, so prefill it with empty linestrings
+    shapes = np.full(len(lengths), shapely.LineString(), dtype=object)
+    shapely.linestrings(
+        coords, indices=np.repeat(np.arange(len(lengths)), lengths), out=shapes
+    )
+    return (shapes, np.split(coords, np.cumsum(lengths)[:-1]))
+
+
 class SupportsParse(T.Protocol):
     @staticmethod
-    def parse(data: T.Dict[str, T.Any], keypoints: T.Dict[str, Node]) -> SupportsParse:
+    def parse_all(
+        data: T.Iterable[T.Dict[str, T.Any]], keypoints: T.Dict[int, Node]
+    ) -> T.Sequence[SupportsParse]:
         pass
 
 
@@ -26,38 +88,72 @@ class Way:
     id: int
     tags: T.Dict[str, str]
     shape: T.Any
+    # (N, 2) array of the shape's coordinates and its endpoints. These are cached so
+    # that consumers can read them without making a shapely call for each access. The
+    # endpoints are set for all ways at once by OsmData.transform, and are None for
+    # ways without any nodes.
+    coords: np.ndarray = dataclasses.field(repr=False, compare=False)
+    first: T.Optional[T.Tuple[float, float]] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+    last: T.Optional[T.Tuple[float, float]] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @staticmethod
-    def parse(data: T.Dict[str, T.Any], keypoints: T.Dict[str, Node]) -> Way:
-        shape = [keypoints[node_id].location for node_id in data["nodes"]]
-        return Way(
-            data["id"],
-            data["tags"],
-            shapely.geometry.LineString(shape),
-        )
-
-    def transform(self, matrix: T.List[float]):
-        self.shape = affine_transform(self.shape, matrix)
+    def parse_all(
+        data: T.Iterable[T.Dict[str, T.Any]], keypoints: T.Dict[int, Node]
+    ) -> T.List[Way]:
+        # consume the records one at a time so that streamed tiles never hold more
+        # than one raw record in memory
+        (ids, tags, lengths) = ([], [], [])
+        locations: T.List[T.Tuple[float, float]] = []
+        for d in data:
+            ids.append(d["id"])
+            tags.append(d["tags"])
+            locations.extend(keypoints[node_id].location for node_id in d["nodes"])
+            lengths.append(len(d["nodes"]))
+
+        # NOTE: the shapes are left empty here; OsmData.transform builds the shapes of
+        # the ways from all tiles together in a single shapely call
+        coords = np.array(locations, dtype=np.float64).reshape(-1, 2)
+        way_coords = np.split(coords, np.cumsum(lengths)[:-1])
+        return [
+            Way(way_id, way_tags, None, c)
+            for (way_id, way_tags, c) in zip(ids, tags, way_coords)
+        ]
 
 
 @dataclass
 class Node:
     id: int
     tags: T.Dict[str, str]
-    location: T.Tuple[float, float]  # (lon, lat)
+    # (N, 2) array of (lon, lat) shared by all nodes parsed together, and the row
+    # belonging to this node. Storing locations column-wise lets us transform all of
+    # them with a single matrix multiplication.
+    locations: np.ndarray = dataclasses.field(repr=False, compare=False)
+    index: int = dataclasses.field(repr=False, compare=False)
 
-    @staticmethod
-    def parse(data: T.Dict[str, T.Any], keypoints: T.Dict[str, Node]) -> Node:
-        return Node(
-            data["id"],
-            data["tags"],
-            (undecimicro(data["decimicro_lon"]), undecimicro(data["decimicro_lat"])),
-        )
+    @property
+    def location(self) -> T.Tuple[float, float]:
+        (x, y) = self.locations[self.index]
+        return (x, y)
 
-    def transform(self, matrix: T.List[float]):
-        p = shapely.geometry.Point(self.location)
-        t = affine_transform(p, matrix)
-        self.location = (t.x, t.y)
+    @staticmethod
+    def parse_all(
+        data: T.Iterable[T.Dict[str, T.Any]], keypoints: T.Dict[int, Node]
+    ) -> T.List[Node]:
+        (ids, tags, decimicro) = ([], [], [])
+        for d in data:
+            ids.append(d["id"])
+            tags.append(d["tags"])
+            decimicro.append((d["decimicro_lon"], d["decimicro_lat"]))
+
+        locations = undecimicro(np.array(decimicro, dtype=np.float64).reshape(-1, 2))
+        return [
+            Node(node_id, node_tags, locations, i)
+            for (i, (node_id, node_tags)) in enumerate(zip(ids, tags))
+        ]
 
 
 @dataclass
@@ -67,13 +163,10 @@ class RelMember:
     role: str
 
     @staticmethod
-    def parse(data: T.Dict[str, T.Any], keypoints: T.Dict[str, Node]) -> RelMember:
+    def parse(data: T.Dict[str, T.Any], keypoints: T.Dict[int, Node]) -> RelMember:
         (type, ref) = list(data["member"].items())[0]
         return RelMember(ref, type[0].lower(), data["role"])
 
-    def transform(self, matrix: T.List[float]):
-        pass
-
 
 @dataclass
 class Relation:
@@ -82,16 +175,18 @@ class Relation:
     members: T.List[RelMember]
 
     @staticmethod
-    def parse(data: T.Dict[str, T.Any], keypoints: T.Dict[str, Node]) -> Relation:
+    def parse(data: T.Dict[str, T.Any], keypoints: T.Dict[int, Node]) -> Relation:
         return Relation(
             data["id"],
             data["tags"],
             list(map(lambda rel: RelMember.parse(rel, keypoints), data["refs"])),
         )
 
-    def transform(self, matrix: T.List[float]):
-        for member in self.members:
-            member.transform(matrix)
+    @staticmethod
+    def parse_all(
+        data: T.Iterable[T.Dict[str, T.Any]], keypoints: T.Dict[int, Node]
+    ) -> T.List[Relation]:
+        return [Relation.parse(d, keypoints) for d in data]
 
 
 FIELDS: T.Dict[str, T.Type[SupportsParse]] = {
@@ -112,33 +207,76 @@ class OsmData:
     subway_route_masters: T.List[Relation]
     subway_routes: T.List[Relation]
     highways: T.List[Way]
+    subway_map: T.Dict[int, Way]
+    stop_map: T.Dict[int, Node]
 
     def __init__(self):
         for field in FIELDS:
             setattr(self, field, [])
-
-    @functools.cached_property
-    def subway_map(self) -> T.Dict[int, Way]:
-        return {subway.id: subway for subway in self.subways}
-
-    @functools.cached_property
-    def stop_map(self) -> T.Dict[int, Node]:
-        return {stop.id: stop for stop in self.stops}
+        # backing location arrays of all nodes; see Node
+        self.node_locations: T.List[np.ndarray] = []
+        self.build_maps()
+
+    def extend(self, field: str, items: T.Sequence[T.Any]):
+        """
+        Add parsed items to the given field.
+        """
+        getattr(self, field).extend(items)
+        if FIELDS[field] is Node and len(items) > 0:
+            self.node_locations.append(items[0].locations)
+
+    def build_maps(self):
+        """
+        Build the id lookup maps. Needs to be called again after modifying the
+        subways or stops.
+        """
+        self.subway_map = {subway.id: subway for subway in self.subways}
+        self.stop_map = {stop.id: stop for stop in self.stops}
 
     def transform(self, matrix: T.List[float]):
-        for field in FIELDS:
-            for item in getattr(self, field):
-                item.transform(matrix)
+        # Transform everything of the same kind at once instead of making a shapely
+        # call per object. Relations only reference other items, so they are skipped.
+        ways = [
+            way
+            for field, cls in FIELDS.items()
+            if cls is Way
+            for way in getattr(self, field)
+        ]
+        if len(ways) > 0:
+            # transform the cached coordinates of all ways at once and then build all
+            # of the shapes from them in one shapely call
+            coords = affine_coords(np.concatenate([way.coords for way in ways]), matrix)
+            lengths = [len(way.coords) for way in ways]
+            (shapes, way_coords) = build_linestrings(coords, lengths)
+            # gather all of the endpoints at once too, rather than per way. Ways without
+            # any nodes have no endpoints.
+            ends = np.cumsum(lengths)
+            starts = ends - lengths
+            nonempty = ends > starts
+            endpoints = zip(
+                coords[starts[nonempty]].tolist(), coords[ends[nonempty] - 1].tolist()
+            )
+            for (way, shape, c) in zip(ways, shapes, way_coords):
+                way.shape = shape
+                way.coords = c
+                if len(c) > 0:
+                    (first, last) = next(endpoints)
+                    (way.first, way.last) = (tuple(first), tuple(last))
+                else:
+                    (way.first, way.last) = (None, None)
+
+        # nodes share their backing location arrays, so transform each array in place
+        for locations in self.node_locations:
+            locations[:] = affine_coords(locations, matrix)
 
     def plot_route(self, plt, route):
         color = route.tags.get("colour")
+        subway_map = self.subway_map
         for member in route.members:
-            if (
-                member.type == "w"
-                and member.ref in self.subway_map
-                and member.role == ""
-            ):
-                subway = self.subway_map[member.ref]
+            if member.type != "w" or member.role != "":
+                continue
+            subway = subway_map.get(member.ref)
+            if subway is not None:
                 plt.plot(*subway.shape.xy, color=color)
 
     def plot_highway(self, plt, highway):
@@ -164,7 +302,101 @@ class OsmData:
             self.plot_highway(axs[1], highway)
 
 
-def read_osm(dataset: T.Dict[str, T.Any], coords: Coords, max_dim: int) -> T.Any:
+# Tiles larger than this many bytes are streamed record by record instead of being
+# loaded all at once. This bounds peak memory, but parsing is slower.
+STREAM_TILE_SIZE = 256 * 2**20
+
+# Part of the key of cached parsed tiles (see read_osm). Cache entries are pickled
+# OsmData, so this needs to be bumped whenever the layout of the parsed data changes.
+OSM_CACHE_VERSION = 1
+
+
+def read_tile(path: str) -> T.Optional[bytes]:
+    if os.path.getsize(path) > STREAM_TILE_SIZE:
+        # too big to load at once; stream it with stream_tile instead
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def read_tiles(paths: T.List[str]) -> T.Iterator[T.Tuple[str, T.Optional[bytes]]]:
+    """
+    Yield each path along with its contents (see read_tile). The next tile is read in
+    the background while the current one is processed, but no further ahead, so at
+    most two tiles are held in memory at once.
+    """
+    # NOTE: orjson holds the GIL while it builds the parsed objects, so only the file
+    # reads are worth overlapping with parsing
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        previous = None
+        for path in paths:
+            future = executor.submit(read_tile, path)
+            if previous is not None:
+                yield (previous[0], previous[1].result())
+            previous = (path, future)
+        if previous is not None:
+            yield (previous[0], previous[1].result())
+
+
+def load_tile(raw: bytes) -> T.Iterator[T.Tuple[str, T.Iterable[T.Dict[str, T.Any]]]]:
+    """
+    Yield the records of each field of a tile, starting with the keypoints.
+    """
+    data = orjson.loads(raw)
+    for field in ["keypoints", *FIELDS]:
+        yield (field, data[field])
+
+
+def stream_tile(path: str) -> T.Iterator[T.Tuple[str, T.Iterable[T.Dict[str, T.Any]]]]:
+    """
+    Like load_tile, but for tiles that are too big to load at once. The keypoints are
+    read in a first pass, since the other fields reference them, and all other fields
+    are read together in a second pass.
+
+    NOTE: each field's records need to be consumed before moving on to the next field.
+    """
+    with open(path, "rb") as f:
+        yield ("keypoints", ijson.items(f, "keypoints.item"))
+
+    with open(path, "rb") as f:
+        records = stream_records(ijson.parse(f), set(FIELDS))
+        for (field, group) in itertools.groupby(records, key=operator.itemgetter(0)):
+            yield (field, (record for (_, record) in group))
+
+
+def stream_records(
+    events: T.Iterable[T.Tuple[str, str, T.Any]], fields: T.Set[str]
+) -> T.Iterator[T.Tuple[str, T.Dict[str, T.Any]]]:
+    """
+    Build the records of the given top-level fields from a stream of ijson.parse
+    events, yielding each one along with its field.
+    """
+    prefixes = {"{}.item".format(field): field for field in fields}
+    prefix: T.Optional[str] = None
+    builder: T.Optional[ijson.ObjectBuilder] = None
+    for (event_prefix, event, value) in events:
+        if builder is None:
+            if event == "start_map" and event_prefix in prefixes:
+                (prefix, builder) = (event_prefix, ijson.ObjectBuilder())
+                builder.event(event, value)
+        else:
+            builder.event(event, value)
+            if event == "end_map" and event_prefix == prefix:
+                yield (prefixes[event_prefix], builder.value)
+                (prefix, builder) = (None, None)
+
+
+def read_osm(
+    dataset: T.Dict[str, T.Any],
+    coords: Coords,
+    max_dim: int,
+    cache_dir: T.Optional[str] = None,
+) -> T.Any:
+    """
+    Read the OSM tiles of a dataset and transform them to map coordinates. If
+    cache_dir is set, the parsed tiles are cached there, keyed by OSM_CACHE_VERSION and
+    the paths and modification times of the tiles.
+    """
     (min_lon, max_lon) = (
         coords.lon - coords.lon_radius,
         coords.lon + coords.lon_radius,
@@ -180,25 +412,55 @@ def read_osm(dataset: T.Dict[str, T.Any], coords: Coords, max_dim: int) -> T.Any
     yscale = max_dim / (max_lat - min_lat)
     matrix = [xscale, 0, 0, yscale, -min_lon * xscale, -min_lat * yscale]
 
-    osm = OsmData()
+    paths = sorted(dataset["tiles"])
+    if cache_dir is None:
+        osm = parse_tiles(paths)
+    else:
+        # parsing doesn't depend on the map coordinates, so the cache is only keyed by
+        # the tiles themselves
+        tiles = [(path, os.path.getmtime(path)) for path in paths]
+        key = hashlib.blake2b(
+            repr((OSM_CACHE_VERSION, tiles)).encode(), digest_size=16
+        ).hexdigest()
+        cache_path = os.path.join(cache_dir, "{}.pkl".format(key))
+
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                osm = pickle.load(f)
+        else:
+            osm = parse_tiles(paths)
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file first so that an interrupted run can't leave
+            # behind a truncated cache entry
+            with open(cache_path + ".tmp", "wb") as f:
+                pickle.dump(osm, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + ".tmp", cache_path)
 
-    for path in sorted(dataset["tiles"]):
-        with open(path, "r") as f:
-            data = json.load(f)
+    # rotate to correct orientation
+    # TODO: figure out why this is necessary
+    # NOTE: composed with the translation/scaling so that we only do one pass
+    osm.transform(compose_affine([1, 0, 0, -1, 0, max_dim], matrix))
+
+    return osm
 
-        keypoints = {data["id"]: Node.parse(data, {}) for data in data["keypoints"]}
 
-        for field, cls in FIELDS.items():
-            getattr(osm, field).extend([cls.parse(d, keypoints) for d in data[field]])
+def parse_tiles(paths: T.List[str]) -> OsmData:
+    osm = OsmData()
+
+    for (path, raw) in read_tiles(paths):
+        tile = stream_tile(path) if raw is None else load_tile(raw)
+
+        keypoints: T.Dict[int, Node] = {}
+        for (field, records) in tile:
+            if field == "keypoints":
+                keypoints = {node.id: node for node in Node.parse_all(records, {})}
+            else:
+                osm.extend(field, FIELDS[field].parse_all(records, keypoints))
 
     # sort to ensure hermeticity
     for field in FIELDS:
-        getattr(osm, field).sort(key=lambda x: x.id)
-
-    osm.transform(matrix)
+        getattr(osm, field).sort(key=operator.attrgetter("id"))
 
-    # rotate to correct orientation
-    # TODO: figure out why this is necessary
-    osm.transform([1, 0, 0, -1, 0, max_dim])
+    osm.build_maps()
 
     return osm
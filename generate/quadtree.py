@@ -1,20 +1,32 @@
-from dataclasses import dataclass
+import functools
+import typing as T
 
+import numpy as np
 
-@dataclass
-class ConvolveData:
+
+# NOTE: one of these is created for every node visited by Quadtree.convolve, and
+# tuples are much cheaper to create than dataclass instances
+class ConvolveData(T.NamedTuple):
     x: int
     y: int
     depth: int
     address: list[int]
+    # Morton (Z-order) code of the node among the nodes at its depth; this is the
+    # address read as a base-4 number
+    morton: int
 
 
 class Quadtree:
     CHILD_QUADRANTS = [(0, 0), (0, 1), (1, 0), (1, 1)]
 
+    # there are a lot of nodes, so avoid having a __dict__ for each one
+    __slots__ = ("max_depth", "data", "children")
+
     def __init__(self, max_depth=0, data=None):
         self.max_depth = max_depth
         self.data = data
+        # either empty or one child per quadrant; children are only ever added all at
+        # once, so this isn't checked during traversal
         self.children = []
 
     def add_children(self, data_f):
@@ -44,29 +56,68 @@ class Quadtree:
             for child in self.children:
                 child.fill(data_f, depth=depth - 1)
 
-    def _convolve_internal(self, f, post, x, y, depth, address):
-        assert len(self.children) in [0, 4]
-
-        data = ConvolveData(x=x, y=y, depth=depth, address=address)
-
-        if not post:
-            f(self, data)
-        for (i, (child, (cx, cy))) in enumerate(
-            zip(self.children, Quadtree.CHILD_QUADRANTS)
-        ):
-            child._convolve_internal(
-                f,
-                post,
-                x + cx * 2 ** (self.max_depth - 1),
-                y + cy * 2 ** (self.max_depth - 1),
-                depth + 1,
-                address + [i],
-            )
-        if post:
-            f(self, data)
+    @staticmethod
+    @functools.lru_cache
+    def child_offsets(max_depth: int) -> T.List[T.List[T.Tuple[int, int]]]:
+        """
+        Return the (x, y) offset of each child from its parent in a tree with the
+        given maximum depth, indexed by the depth of the parent and then by quadrant.
+        """
+        return [
+            [
+                (cx << (max_depth - depth - 1), cy << (max_depth - depth - 1))
+                for (cx, cy) in Quadtree.CHILD_QUADRANTS
+            ]
+            for depth in range(max_depth)
+        ]
 
     def convolve(self, f, post=False):
-        self._convolve_internal(f=f, post=post, x=0, y=0, depth=0, address=[])
+        """
+        Call f(node, data) for every node in the tree. Parents are visited before
+        their children, or after them if post is set.
+
+        NOTE: data.address is a single list that is updated in place as the traversal
+        moves through the tree, so callbacks must copy it if they want to keep it.
+        """
+        child_offsets = Quadtree.child_offsets(self.max_depth)
+
+        address: list[int] = []
+
+        # iterate with an explicit stack instead of recursing; each entry is (node, x,
+        # y, depth, morton, whether the children have already been visited)
+        stack = [(self, 0, 0, 0, 0, False)]
+        while stack:
+            (node, x, y, depth, morton, visited) = stack.pop()
+
+            if visited:
+                del address[depth:]
+                f(node, ConvolveData(x, y, depth, address, morton))
+                continue
+
+            if depth > 0:
+                del address[depth - 1 :]
+                address.append(morton & 3)
+
+            if post:
+                stack.append((node, x, y, depth, morton, True))
+            else:
+                f(node, ConvolveData(x, y, depth, address, morton))
+
+            if len(node.children) > 0:
+                offsets = child_offsets[depth]
+                # push in reverse so that children are visited in order
+                for i in reversed(range(len(Quadtree.CHILD_QUADRANTS))):
+                    (dx, dy) = offsets[i]
+                    stack.append(
+                        (
+                            node.children[i],
+                            x + dx,
+                            y + dy,
+                            depth + 1,
+                            4 * morton + i,
+                            False,
+                        )
+                    )
 
     def __str__(self):
         assert len(self.children) in [0, 4]
@@ -76,3 +127,60 @@ class Quadtree:
             return "Quadtree([{}, {}])".format(
                 self.data, ", ".join([str(c) for c in self.children])
             )
+
+
+class QuadtreeStore:
+    """
+    Per-node values of a complete quadtree, stored as flat arrays with one array per
+    field. Nodes are laid out level by level, and within a level in Morton order, so
+    the four children of a node are adjacent and each level can be processed with a
+    single vectorized operation.
+    """
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        # the nodes at depth d are at indices offsets[d]:offsets[d + 1]
+        self.offsets = [(4**d - 1) // 3 for d in range(depth + 2)]
+        self.fields: T.Dict[str, np.ndarray] = {}
+
+    @staticmethod
+    def morton_codes(depth: int) -> np.ndarray:
+        """
+        Return a (2^depth, 2^depth) array holding the Morton code of each (x, y).
+        """
+        coords = np.arange(2**depth, dtype=np.int64)
+        spread = np.zeros_like(coords)
+        for bit in range(depth):
+            spread |= ((coords >> bit) & 1) << (2 * bit)
+        # x is the more significant bit of each quadrant; see Quadtree.CHILD_QUADRANTS
+        return (spread[:, np.newaxis] << 1) | spread[np.newaxis, :]
+
+    def add_field(self, name: str, grid: np.ndarray, reduce: np.ufunc):
+        """
+        Add a field. The values of the deepest nodes come from grid, indexed as
+        grid[x][y], and the value of every other node is reduce applied to the values
+        of its four children. reduce must be an associative binary ufunc.
+        """
+        dim = 2**self.depth
+        assert grid.shape == (dim, dim), (grid.shape, self.depth)
+
+        values = np.empty(self.offsets[-1], dtype=grid.dtype)
+        values[self.offsets[self.depth] :][self.morton_codes(self.depth)] = grid
+
+        for depth in reversed(range(self.depth)):
+            children = values[self.offsets[depth + 1] : self.offsets[depth + 2]]
+            parents = values[self.offsets[depth] : self.offsets[depth + 1]]
+            # NOTE: reducing along an axis of length 4 is slow in NumPy, so instead
+            # combine strided views of the children pairwise, which vectorizes well
+            pair = reduce(children[2::4], children[3::4])
+            reduce(children[0::4], children[1::4], out=parents)
+            reduce(parents, pair, out=parents)
+
+        self.fields[name] = values
+
+    def index(self, convolve: ConvolveData) -> int:
+        """
+        Return the index of the node being visited. Only valid for nodes at most
+        self.depth deep.
+        """
+        return self.offsets[convolve.depth] + convolve.morton
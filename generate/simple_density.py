@@ -10,6 +10,7 @@ class SimpleDensity(Layer):
     def __init__(self, map_config: MapConfig, tile_name: str):
         super().__init__(map_config)
         self.tile_name = tile_name
+        self.people_per_sim = map_config.engine_config["people_per_sim"]
 
     def initialize(self, data: int, node: Quadtree, convolve: ConvolveData):
         if math.isnan(data):
@@ -17,7 +18,7 @@ class SimpleDensity(Layer):
         assert data >= 0, data
 
         # convert real people units to simulated people units
-        data /= self.map_config.engine_config["people_per_sim"]
+        data /= self.people_per_sim
 
         if data == 0:
             self.clear_node_data(node)
@@ -25,7 +26,7 @@ class SimpleDensity(Layer):
             # potentially subdivide into many small tiles
             units = math.floor(data)
             per_unit = data / units
-            self.set_node_data(node, [per_unit for _ in range(units)], 0)
+            self.set_node_data(node, [per_unit] * units, 0)
         else:
             # most likely need to merge with neighboring tiles
             self.set_node_data(node, [data], 0)
@@ -45,7 +46,7 @@ class SimpleDensity(Layer):
 
             units = max(math.floor(total), 1)
             per_unit = total / units
-            self.set_node_data(node, [per_unit for _ in range(units)], 0)
+            self.set_node_data(node, [per_unit] * units, 0)
 
     def finalize(self, data: float) -> Tile:
         if 0.2 < data < 1:
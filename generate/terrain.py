@@ -1,7 +1,10 @@
+import math
 import typing as T
 
+import numpy as np
+
 from generate.layer import Layer, Tile
-from generate.quadtree import Quadtree, ConvolveData
+from generate.quadtree import Quadtree, ConvolveData, QuadtreeStore
 
 
 class Terrain(Layer):
@@ -18,17 +21,28 @@ class Terrain(Layer):
             self.set_node_data(node, [False], -100)
 
     def post_init(self, dataset: T.Any, qtree: Quadtree):
-        pass
-
-    def node_has_water(self, node: Quadtree) -> bool:
-        return self.get_node_data(node)[0]
+        # Precompute whether all/any of the tiles under every node are water. Merge is
+        # only called when all four children are themselves uniform, so they all have
+        # the same value exactly when all == any for the node.
+        (dim, _) = dataset.shape
+        water = (dataset == 210).astype(np.uint8)
+        self.store = QuadtreeStore(int(math.log2(dim)))
+        self.store.add_field("all_water", water, np.bitwise_and)
+        self.store.add_field("any_water", water, np.bitwise_or)
+
+    def __getstate__(self):
+        # the store is only needed while generating and can be large, so don't pickle it
+        state = self.__dict__.copy()
+        state.pop("store", None)
+        return state
 
     def merge(self, node: Quadtree, convolve: ConvolveData):
-        first = self.node_has_water(node.children[0])
-        if all([self.node_has_water(c) == first for c in node.children]):
+        index = self.store.index(convolve)
+        water = bool(self.store.fields["all_water"][index])
+        if water == bool(self.store.fields["any_water"][index]):
             for child in node.children:
                 self.clear_node_data(child)
-            self.set_node_data(node, [first], 100 if first else -100)
+            self.set_node_data(node, [water], 100 if water else -100)
 
     def finalize(self, data: bool) -> Tile:
         if data:
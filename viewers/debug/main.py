@@ -1,7 +1,6 @@
 import time
 import os
 import math
-import functools
 
 import argh
 
@@ -16,6 +15,10 @@ if True:
 
 WINDOW_SIZE = (1920, 1080)
 FRAMERATE = 60
+# how long to wait for an event when idle before updating the GUI anyway; ms
+IDLE_TIMEOUT = 250
+# how often to refresh the diagnostics panel; seconds
+DIAGNOSTICS_INTERVAL = 0.25
 DEFAULT_SCALE = 4
 
 DEFAULT_CONFIG = "config/debug.toml"
@@ -51,6 +54,16 @@ def main(config=DEFAULT_CONFIG, load_file=None):
     pygame.init()
     display = pygame.display.set_mode(WINDOW_SIZE)
 
+    # the rendered tiles, which are only redrawn when something changes (dirty). It
+    # has no alpha and is converted to the display's pixel format, so that blitting it
+    # every frame is a plain copy.
+    world_surface = pygame.Surface(WINDOW_SIZE).convert()
+    dirty = True
+    # rendering of the whole world at the current scale, used while all of it fits in
+    # the window so that panning only needs a blit. Stored as (key, surface, leaves
+    # drawn), and reset to None when the tiles change.
+    world_cache = None
+
     font = pygame.freetype.SysFont(pygame.freetype.get_default_font(), 20)
 
     gui = pygame_gui.UIManager(WINDOW_SIZE)
@@ -61,14 +74,19 @@ def main(config=DEFAULT_CONFIG, load_file=None):
         starting_layer_height=1,
     )
 
-    detail_panel_address = pygame_gui.elements.UITextEntryLine(
-        relative_rect=pygame.Rect((10, 10), (370, 0)),
+    # NOTE: read-only text uses labels, which are much cheaper than disabled text
+    # entry lines
+
+    detail_panel_address = pygame_gui.elements.UILabel(
+        relative_rect=pygame.Rect((10, 10), (370, 30)),
+        text="",
         manager=gui,
         container=detail_panel,
     )
 
-    detail_panel_json = pygame_gui.elements.UITextEntryLine(
-        relative_rect=pygame.Rect((10, 50), (370, 0)),
+    detail_panel_json = pygame_gui.elements.UILabel(
+        relative_rect=pygame.Rect((10, 50), (370, 30)),
+        text="",
         manager=gui,
         container=detail_panel,
     )
@@ -92,26 +110,28 @@ def main(config=DEFAULT_CONFIG, load_file=None):
         starting_layer_height=1,
     )
 
-    diagnostics_panel_rendered = pygame_gui.elements.UITextEntryLine(
-        relative_rect=pygame.Rect((10, 10), (370, 0)),
+    diagnostics_panel_rendered = pygame_gui.elements.UILabel(
+        relative_rect=pygame.Rect((10, 10), (370, 30)),
+        text="",
         manager=gui,
         container=diagnostics_panel,
     )
-    diagnostics_panel_rendered.disable()
 
-    diagnostics_panel_framerate = pygame_gui.elements.UITextEntryLine(
-        relative_rect=pygame.Rect((10, 50), (370, 0)),
+    diagnostics_panel_framerate = pygame_gui.elements.UILabel(
+        relative_rect=pygame.Rect((10, 50), (370, 30)),
+        text="",
         manager=gui,
         container=diagnostics_panel,
     )
-    diagnostics_panel_framerate.disable()
 
     selected_tile = None
     detail_panel.disable()
 
     def select_tile(address):
-        nonlocal selected_tile
+        nonlocal selected_tile, dirty, world_cache
         selected_tile = address
+        dirty = True
+        world_cache = None
 
         if selected_tile is None:
             detail_panel.disable()
@@ -121,10 +141,8 @@ def main(config=DEFAULT_CONFIG, load_file=None):
         else:
             detail_panel.enable()
             detail_panel_address.set_text(str(address.get()))
-            detail_panel_address.disable()
             json = state.get_leaf_json(address)
             detail_panel_json.set_text(json)
-            detail_panel_json.disable()
             detail_panel_json_edit.set_text(json)
             if len(address.get()) < state.max_depth:
                 detail_panel_split.enable()
@@ -132,7 +150,10 @@ def main(config=DEFAULT_CONFIG, load_file=None):
                 detail_panel_split.disable()
 
     def split_tile(address):
+        nonlocal dirty, world_cache
         if len(address.get()) < state.max_depth:
+            dirty = True
+            world_cache = None
             state.split(
                 address,
                 engine.BranchState(),
@@ -144,13 +165,10 @@ def main(config=DEFAULT_CONFIG, load_file=None):
             if selected_tile is not None and selected_tile.get() == address.get():
                 select_tile(None)
 
-    @functools.cache
-    def text_map(text):
-        return font.render(text, Colors.TEXT)
-
-    def screen_coords(m):
-        mx, my = m
-        return (mx * scale + tx, my * scale + ty)
+    # rendered tile names as (text, rect, minimum tile width to show the text), indexed
+    # by name; there are only a few distinct names. This is a plain dict rather than
+    # functools.cache since it is read for every leaf.
+    text_cache = {}
 
     def model_coords(s):
         sx, sy = s
@@ -163,43 +181,100 @@ def main(config=DEFAULT_CONFIG, load_file=None):
         else:
             return None
 
-    def visit_branch(branch, data):
-        if data.width * scale >= 10:
-            return True
-        else:
-            # don't draw things that are too small to see
-            x, y = screen_coords((data.x, data.y))
+    def draw_tiles(surface, scale, tx, ty):
+        """
+        Draw the tiles that are visible on surface, where model coordinates (x, y) are
+        drawn at (x * scale + tx, y * scale + ty). Returns the number of leaves drawn.
+        """
+        (surface_w, surface_h) = surface.get_size()
+        x1, y1 = (round(-tx / scale), round(-ty / scale))
+        x2, y2 = (round((surface_w - tx) / scale), round((surface_h - ty) / scale))
+
+        # read once per redraw rather than once per leaf
+        selected_address = selected_tile.get() if selected_tile is not None else None
+
+        # hidden branches as (x, y, w, w), outlines of the visible leaves as (corners,
+        # line width) and their names as (text, position), collected during the
+        # traversal and drawn all at once afterwards
+        hidden_rects = []
+        leaf_outlines = []
+        text_blits = []
+
+        rendered = 0
+
+        # NOTE: the visitors are called for every visible tile, so they transform model
+        # coordinates to screen coordinates (the inverse of model_coords) inline
+
+        def visit_branch(branch, data):
+            # The engine only checks whether a branch is in bounds after calling this,
+            # so skip branches that are entirely outside of the surface before drawing
+            # them.
+            if (
+                data.x + data.width < x1
+                or data.x > x2
+                or data.y + data.width < y1
+                or data.y > y2
+            ):
+                return False
+
             w = data.width * scale
-            pygame.draw.rect(display, Colors.TILE_HIDDEN, pygame.Rect(x, y, w, w))
+            if w >= 10:
+                return True
+            else:
+                # don't draw things that are too small to see
+                hidden_rects.append((data.x * scale + tx, data.y * scale + ty, w, w))
 
-    def visit_leaf(leaf, data):
-        x, y = screen_coords((data.x, data.y))
-        w = data.width * scale
+        def visit_leaf(leaf, data):
+            x = data.x * scale + tx
+            y = data.y * scale + ty
+            w = data.width * scale
 
-        if selected_tile is not None and selected_tile.get() == data.address.get():
-            width = 5
-        else:
-            width = 1
-
-        pygame.draw.lines(
-            display,
-            Colors.TILE_SIDES,
-            True,
-            ((x, y), (x + w, y), (x + w, y + w), (x, y + w)),
-            width,
-        )
+            if selected_address is not None and data.address.get() == selected_address:
+                width = 5
+            else:
+                width = 1
+
+            corners = ((x, y), (x + w, y), (x + w, y + w), (x, y + w))
+            leaf_outlines.append((corners, width))
+
+            name = leaf.name
+            cached = text_cache.get(name)
+            if cached is None:
+                text, rect = font.render(name, Colors.TEXT)
+                # convert once so that blitting it doesn't need to convert it every time
+                text = text.convert_alpha(world_surface)
+                cached = text_cache[name] = (text, rect, rect.width * 1.5)
+            text, rect, min_w = cached
+            if w > min_w:
+                text_blits.append(
+                    (text, (x + w / 2 - rect.width / 2, y + w / 2 - rect.height / 2))
+                )
 
-        text, rect = text_map(leaf.name)
-        if w > rect.width * 1.5:
-            display.blit(
-                text, (x + w / 2 - rect.width / 2, y + w / 2 - rect.height / 2)
-            )
+            nonlocal rendered
+            rendered += 1
 
-        nonlocal rendered
-        rendered += 1
+        surface.fill(Colors.BACKGROUND)
+        state.visit_rect(
+            visit_branch, visit_leaf, max(x1, 0), max(x2, 0), max(y1, 0), max(y2, 0)
+        )
+
+        # NOTE: rects are passed as plain tuples so that pygame converts them in C
+        # instead of constructing a pygame.Rect for each one
+        fill = surface.fill
+        for rect in hidden_rects:
+            fill(Colors.TILE_HIDDEN, rect)
+        # NOTE: draw.rect would draw inside the rect and convert its position and size
+        # separately, so neighboring outlines wouldn't line up; draw.lines centers the
+        # lines on the shared edges
+        draw_lines = pygame.draw.lines
+        for (corners, width) in leaf_outlines:
+            draw_lines(surface, Colors.TILE_SIDES, True, corners, width)
+        surface.blits(text_blits, doreturn=False)
+
+        return rendered
 
     def handle_event(event):
-        nonlocal tx, ty
+        nonlocal tx, ty, dirty
         if event.type == pygame.QUIT:
             raise KeyboardInterrupt
         elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -210,6 +285,7 @@ def main(config=DEFAULT_CONFIG, load_file=None):
             if event.buttons[Controls.PAN_MOUSE_BUTTON - 1]:
                 tx += event.rel[0]
                 ty += event.rel[1]
+                dirty = True
         elif event.type == pygame.MOUSEWHEEL:
             nonlocal scale
             mouse_x, mouse_y = pygame.mouse.get_pos()
@@ -217,24 +293,20 @@ def main(config=DEFAULT_CONFIG, load_file=None):
 
             # Zoom centered on the mouse
             # Invariant: (mouse_x - tx) / scale = (mouse_x - tx') / scale'
-            # Solved: tx' = (mouse_x * scale - mouse_x * scale' + tx * scale') / scale
-            tx = (mouse_x * scale - mouse_x * new_scale + tx * new_scale) / scale
-            ty = (mouse_y * scale - mouse_y * new_scale + ty * new_scale) / scale
+            # Solved: tx' = mouse_x + (tx - mouse_x) * (scale' / scale)
+            ratio = new_scale / scale
+            tx = mouse_x + (tx - mouse_x) * ratio
+            ty = mouse_y + (ty - mouse_y) * ratio
 
             scale = new_scale
+            dirty = True
         elif event.type == pygame.KEYDOWN:
             # detect ctrl+s
-            if event.key == ord("s") and event.mod in [
-                pygame.KMOD_LCTRL,
-                pygame.KMOD_RCTRL,
-            ]:
+            if event.key == pygame.K_s and event.mod & pygame.KMOD_CTRL:
                 state.save(
                     "/tmp/metro_simulator_{}.json".format(math.floor(time.time()))
                 )
-            elif event.key == ord("t") and event.mod in [
-                pygame.KMOD_LCTRL,
-                pygame.KMOD_RCTRL,
-            ]:
+            elif event.key == pygame.K_t and event.mod & pygame.KMOD_CTRL:
                 if selected_tile is not None:
                     split_tile(selected_tile)
                 else:
@@ -257,36 +329,92 @@ def main(config=DEFAULT_CONFIG, load_file=None):
             if event.user_type == pygame_gui.UI_BUTTON_PRESSED:
                 if event.ui_element == detail_panel_split:
                     split_tile(selected_tile)
+        elif event.type in (
+            pygame.VIDEOEXPOSE,
+            pygame.ACTIVEEVENT,
+            pygame.WINDOWEXPOSED,
+            pygame.WINDOWSHOWN,
+            pygame.WINDOWRESTORED,
+            pygame.WINDOWMAXIMIZED,
+            pygame.WINDOWFOCUSGAINED,
+        ):
+            # the window contents may have been lost, and clean frames only update the
+            # panels, so redraw and update the whole window
+            dirty = True
 
     clock = pygame.time.Clock()
+    # time since the diagnostics were last refreshed; starts full to refresh right away
+    diagnostics_elapsed = DIAGNOSTICS_INTERVAL
 
     while True:
         time_delta = clock.tick(FRAMERATE) / 1000.0
 
-        for event in pygame.event.get():
+        events = pygame.event.get()
+        if len(events) == 0 and not dirty:
+            # nothing is happening, so sleep until something does instead of drawing
+            # frames at the full frame rate
+            event = pygame.event.wait(IDLE_TIMEOUT)
+            if event.type != pygame.NOEVENT:
+                events = [event]
+
+        for event in events:
             gui.process_events(event)
             handle_event(event)
 
         gui.update(time_delta)
 
-        x1, y1 = model_coords((0, 0))
-        x2, y2 = model_coords(display.get_size())
+        if dirty:
+            # leave room for the outlines, which are centered on the tile edges
+            margin = 3
+            size = math.ceil(state.width * scale) + 2 * margin
+            if size <= min(WINDOW_SIZE):
+                # Zoomed out far enough that the whole world fits in the window. Render
+                # all of it once at this scale and only move it around while panning,
+                # rather than traversing the tree again. It is rendered at the
+                # fractional part of the translation, so that blitting it at the
+                # integer part draws the same pixels as drawing it directly.
+                (ix, iy) = (math.floor(tx), math.floor(ty))
+                key = (scale, tx - ix, ty - iy)
+                if world_cache is None or world_cache[0] != key:
+                    cache_surface = pygame.Surface((size, size)).convert()
+                    cached_rendered = draw_tiles(
+                        cache_surface, scale, tx - ix + margin, ty - iy + margin
+                    )
+                    world_cache = (key, cache_surface, cached_rendered)
+                (_, cache_surface, rendered) = world_cache
+
+                world_surface.fill(Colors.BACKGROUND)
+                world_surface.blit(cache_surface, (ix - margin, iy - margin))
+            else:
+                rendered = draw_tiles(world_surface, scale, tx, ty)
 
-        rendered = 0
+            dirty = False
 
-        display.fill(Colors.BACKGROUND)
-        state.visit_rect(
-            visit_branch, visit_leaf, max(x1, 0), max(x2, 0), max(y1, 0), max(y2, 0)
-        )
-
-        diagnostics_panel_rendered.set_text("Rendered: {}".format(rendered))
-        diagnostics_panel_framerate.set_text(
-            "Frame rate: {}".format(round(clock.get_fps(), 1))
-        )
+            display.blit(world_surface, (0, 0))
+            # the whole window changed
+            update_rects = None
+        else:
+            # only the GUI can have changed, so just restore the tiles under the panels
+            # and only update those parts of the window
+            update_rects = [detail_panel.rect, diagnostics_panel.rect]
+            for rect in update_rects:
+                display.blit(world_surface, rect, rect)
+
+        # setting the text re-renders it, so don't do it every frame
+        diagnostics_elapsed += time_delta
+        if diagnostics_elapsed >= DIAGNOSTICS_INTERVAL:
+            diagnostics_elapsed = 0
+            diagnostics_panel_rendered.set_text("Rendered: {}".format(rendered))
+            diagnostics_panel_framerate.set_text(
+                "Frame rate: {}".format(round(clock.get_fps(), 1))
+            )
 
         gui.draw_ui(display)
 
-        pygame.display.update()
+        if update_rects is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(update_rects)
 
 
 if __name__ == "__main__":